@@ -0,0 +1,59 @@
+from imaplib import IMAP4_SSL, IMAP4, MapCRLF, CRLF, Time2Internaldate
+
+# LITERAL+ (RFC 7888) lets the client send a literal as {N+} without
+# waiting for the server continuation, so APPEND goes out in a single
+# write instead of two round-trips. Falls back to imaplib's APPEND when
+# the server does not advertise it.
+class LiteralPlus:
+    def append(self, mailbox, flags, date_time, message):
+        if 'LITERAL+' not in self.capabilities:
+            return super().append(mailbox, flags, date_time, message)
+
+        tag = self._send_append(mailbox, flags, date_time, message)
+        return self._command_complete('APPEND', tag)
+
+    # Nothing has to be waited for before sending a LITERAL+ APPEND, so
+    # the whole list is sent first and the tagged responses are yielded
+    # afterwards, in order, as they are collected: a caller losing the
+    # connection midway still gets the ones that came before.
+    def append_many(self, mailbox, messages):
+        if 'LITERAL+' not in self.capabilities:
+            for m in messages:
+                yield self.append(mailbox, None, None, m)
+            return
+
+        tags = [self._send_append(mailbox, None, None, m) for m in messages]
+        for tag in tags:
+            yield self._command_complete('APPEND', tag)
+
+    # The command, the literal and the final CRLF go out in one send:
+    # written separately, the small writes that follow the first one are
+    # held by Nagle's algorithm until the server ACKs, which it delays.
+    def _send_append(self, mailbox, flags, date_time, message):
+        if not mailbox:
+            mailbox = 'INBOX'
+        if flags and (flags[0], flags[-1]) != ('(', ')'):
+            flags = '(%s)' % flags
+        if date_time:
+            date_time = Time2Internaldate(date_time)
+        literal = MapCRLF.sub(CRLF, message)
+        if self.utf8_enabled:
+            literal = b'UTF8 (' + literal + b')'
+
+        tag = self._new_tag()
+        parts = [tag, b' APPEND']
+        for arg in (mailbox, flags or None, date_time or None):
+            if arg is None:
+                continue
+            if isinstance(arg, str):
+                arg = bytes(arg, self._encoding)
+            parts += [b' ', arg]
+        parts += [b' {%d+}' % len(literal), CRLF, literal, CRLF]
+        self.send(b''.join(parts))
+        return tag
+
+class IMAP4_LiteralPlus(LiteralPlus, IMAP4):
+    pass
+
+class IMAP4_SSL_LiteralPlus(LiteralPlus, IMAP4_SSL):
+    pass
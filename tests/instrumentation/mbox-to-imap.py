@@ -1,10 +1,16 @@
-from imaplib import IMAP4_SSL, IMAP4
-from os import listdir
-from os.path import isfile, join
+from imaplib import MapCRLF, CRLF
+from literal_plus import IMAP4_SSL_LiteralPlus, IMAP4_LiteralPlus
+from itertools import islice
+import re
+import socket
 import sys
 import argparse
 import mailbox
 
+BUFSIZE = 1 << 20
+# mboxrd quoting of body lines starting with "From "
+FROM_QUOTE = re.compile(rb'^>(>*From )', re.MULTILINE)
+
 parser = argparse.ArgumentParser(
         prog='mbox-to-imap',
         description='Send an mbox to an imap server',
@@ -16,24 +22,97 @@ parser.add_argument('-u', '--user')
 parser.add_argument('-s', '--password')
 parser.add_argument('-m', '--mailbox', default="INBOX")
 parser.add_argument('-t', '--tls', action='store_true')
+parser.add_argument('-b', '--batch', type=int, default=50)
+parser.add_argument('-v', '--verbose', action='store_true')
 args = parser.parse_args()
 
-mbox = mailbox.mbox(args.mbox_path)
+# mailbox opens the file itself with the default 8KiB buffer,
+# reopen it read-only with a larger one as we never modify the mbox
+class BufferedMbox(mailbox.mbox):
+    def __init__(self, path):
+        super().__init__(path, create=False)
+        self._file.close()
+        self._file = open(self._path, 'rb', buffering=BUFSIZE)
+
+    # Read messages straight from the table of contents built by mailbox,
+    # without going through its per-key lookup.
+    def raw_messages(self):
+        if self._toc is None:
+            self._generate_toc()
+        for key in sorted(self._toc):
+            (start, stop) = self._toc[key]
+            self._file.seek(start)
+            self._file.readline() # From_ line
+            yield FROM_QUOTE.sub(rb'\1', self._file.read(stop - self._file.tell()))
+
+mbox = BufferedMbox(args.mbox_path)
 
 if args.tls:
-    imap = IMAP4_SSL
+    imap = IMAP4_SSL_LiteralPlus
 else:
-    imap = IMAP4
+    imap = IMAP4_LiteralPlus
 
+# RFC 3502 MULTIAPPEND: send several messages in a single APPEND command.
+# imaplib only knows how to send one literal per command, so we write the
+# command by hand. With LITERAL+ (RFC 7888) literals are non-synchronizing
+# and the whole batch goes out without waiting for the server.
+# Each part is sent on its own so the batch is never held in memory at once,
+# which needs TCP_NODELAY on the socket, see below.
+def multiappend(M, mb, messages):
+    literal_plus = 'LITERAL+' in M.capabilities
+    tag = M._new_tag()
+    M.send(tag + b' APPEND ' + mb.encode())
+    for msg in messages:
+        literal = MapCRLF.sub(CRLF, msg)
+        if literal_plus:
+            M.send(b' {%d+}' % len(literal) + CRLF)
+        else:
+            M.send(b' {%d}' % len(literal) + CRLF)
+            # the server answers NO instead of a continuation to refuse the batch
+            while M._get_response():
+                if M.tagged_commands[tag]:
+                    return M._command_complete('APPEND', tag)
+        M.send(literal)
+    M.send(CRLF)
+    return M._command_complete('APPEND', tag)
 
 print(args)
 with imap(host=args.host, port=args.port) as M:
+    # Without it, Nagle's algorithm holds the small writes that follow a
+    # literal, such as the final CRLF, until the server's delayed ACK.
+    M.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     print(M.login(args.user, args.password))
+    (r, caps) = M.capability()
+    M.capabilities = tuple(caps[-1].decode().upper().split())
     print(M.select(args.mailbox))
-    for k in mbox.keys():
-        content = mbox.get(k).as_bytes()
-        M.append(args.mailbox, [], None, content)
-        print(f"{k}/{len(mbox)}")
+
+    total = len(mbox)
+    failed = 0
+    messages = mbox.raw_messages()
+    if 'MULTIAPPEND' in M.capabilities:
+        done = 0
+        while batch := list(islice(messages, args.batch)):
+            (r, d) = multiappend(M, args.mailbox, batch)
+            # MULTIAPPEND is all or nothing, the whole batch is lost on NO
+            if r != 'OK':
+                failed += len(batch)
+                print(f"failed messages {done}-{done+len(batch)-1}: {(r, d)}")
+            done += len(batch)
+            if args.verbose:
+                print((r, d))
+                print(f"{done}/{total}")
+    else:
+        for (k, content) in enumerate(messages):
+            (r, d) = M.append(args.mailbox, [], None, content)
+            if r != 'OK':
+                failed += 1
+                print(f"failed message {k}: {(r, d)}")
+            if args.verbose:
+                print(f"{k}/{total}")
+    print(f"{total - failed}/{total} messages sent")
+
+if failed:
+    sys.exit(1)
 
 
 
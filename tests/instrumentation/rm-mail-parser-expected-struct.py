@@ -1,17 +1,20 @@
-from os import listdir
-from os.path import isfile, join
+from os import scandir, fstat
+import mmap
 import sys
 
+SENTINEL = b"EXPECTED STRUCTURE"
+
 path = sys.argv[1]
-onlyfiles = [join(path, f) for f in listdir(path) if isfile(join(path, f)) and len(f) > 4 and f[-4:] == ".txt"]
+onlyfiles = [e.path for e in scandir(path) if e.is_file() and e.name.endswith(".txt")]
 
 for p in onlyfiles:
     g = p[:-4] + ".eml"
     print(f"{p} -> {g}")
-    with open(p, 'r+b') as inp:
-        with open(g, 'w+b') as out:
-            for line in inp:
-                if b"EXPECTED STRUCTURE" in line:
-                    break
-                out.write(line)
-            
+    with open(p, 'rb') as inp, open(g, 'wb') as out:
+        if fstat(inp.fileno()).st_size == 0:
+            continue
+        with mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # keep everything before the line holding the marker
+            off = mm.find(SENTINEL)
+            end = mm.rfind(b"\n", 0, off) + 1 if off != -1 else len(mm)
+            out.write(mm[:end])
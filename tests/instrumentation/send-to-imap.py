@@ -1,6 +1,12 @@
 from imaplib import IMAP4_SSL, IMAP4
-from os import listdir
-from os.path import isfile, join
+from literal_plus import LiteralPlus, IMAP4_LiteralPlus
+from os import scandir
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+import mmap
+import argparse
+import re
+import ssl
 import sys
 
 # COMMAND USAGE
@@ -9,26 +15,130 @@ import sys
 #   docker-compose.up
 # then call this script. eg:
 #   ./send-to-imap.py all ./emails/dxflrs/
+# an optional third argument sets how many sessions
+# are used in parallel (default: 4), eg:
+#   ./send-to-imap.py all ./emails/dxflrs/ 8
+# add -v to log every server response
 
 
+# Map the mail instead of reading it: the message is only copied when it
+# is CRLF-normalised and put in the APPEND command.
+# Empty files can't be mapped, they are filtered out beforehand.
+def map_mail(f):
+    with open(f, 'rb') as mail:
+        return memoryview(mmap.mmap(mail.fileno(), 0, access=mmap.ACCESS_READ))
+
 def rebuild_body_res(b):
-    bb = b''
-    for e in b:
-        if type(e) is tuple:
-            bb += b'\r\n'.join([p for p in e])
+    # imaplib gives [None] when the server returned no FETCH data
+    if None in b:
+        raise ValueError("no fetch data")
+    bb = b''.join([b'\r\n'.join(e) if isinstance(e, tuple) else e for e in b])
+
+    start = bb.find(b'(')
+    if start == -1:
+        return bb
+    return bb[start:]
+
+def sexp_end(bb, i):
+    # bb[i] is an opening paren, return the offset right after its closing one
+    depth = 0
+    while i < len(bb):
+        c = bb[i:i+1]
+        if c == b'"':
+            i += 1
+            while i < len(bb) and bb[i:i+1] != b'"':
+                i += 2 if bb[i:i+1] == b'\\' else 1
+        elif c == b'{':
+            j = bb.index(b'}', i)
+            i = j + 3 + int(bb[i+1:j])
+            continue
+        elif c == b'(':
+            depth += 1
+        elif c == b')':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    raise ValueError("unterminated list in fetch response")
+
+def fetch_items(b):
+    # split a "(NAME value NAME value ...)" fetch response into
+    # a dict of NAME -> value, one per fetched attribute
+    bb = rebuild_body_res(b)
+    items = {}
+    i = 1
+    while i < len(bb) and bb[i:i+1] != b')':
+        if bb[i:i+1] == b' ':
+            i += 1
+            continue
+        sp = bb.index(b' ', i)
+        name = bb[i:sp]
+        start = sp + 1
+        if bb[start:start+1] == b'(':
+            end = sexp_end(bb, start)
         else:
-            bb += e
+            end = start
+            while end < len(bb) and bb[end:end+1] not in (b' ', b')'):
+                end += 1
+        items[name] = bb[start:end]
+        i = end
+    if i >= len(bb):
+        raise ValueError("truncated fetch response")
+    return items
+
+FETCH_START = re.compile(rb'\d+ \(')
+
+def split_fetch(b):
+    # group the data returned by a multi-message FETCH by message: each one
+    # starts with "N (" and may be followed by literals and their trailers.
+    # imaplib gives [None] when no message was returned at all.
+    msgs = []
+    for e in b:
+        if e is None:
+            continue
+        head = e[0] if isinstance(e, tuple) else e
+        if FETCH_START.match(head):
+            msgs.append([])
+        if msgs:
+            msgs[-1].append(e)
+    return msgs
+
+# Test servers use self-signed certificates, keep the default context
+# permissive but share it so sessions can be resumed on reconnect.
+tls_ctx = ssl.create_default_context()
+tls_ctx.check_hostname = False
+tls_ctx.verify_mode = ssl.CERT_NONE
+tls_sessions = {}
 
-    f = bb[bb.find(b'('):]
-    return f
+class IMAP4_SSL_Resume(LiteralPlus, IMAP4_SSL):
+    def __init__(self, host='', port=993):
+        super().__init__(host, port, ssl_context=tls_ctx)
 
-mode = sys.argv[1]
-path = sys.argv[2]
+    def _create_socket(self, timeout):
+        sock = IMAP4._create_socket(self, timeout)
+        session = tls_sessions.get((self.host, self.port))
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.host, session=session)
+
+parser = argparse.ArgumentParser(
+        prog='send-to-imap',
+        description='Dump BODY and BODYSTRUCTURE as computed by test imap servers',
+        epilog='Just a debug tool')
+parser.add_argument('mode')
+parser.add_argument('path')
+parser.add_argument('workers', nargs='?', type=int, default=4)
+parser.add_argument('-v', '--verbose', action='store_true')
+args = parser.parse_args()
+
+mode = args.mode
+path = args.path
+workers = args.workers
+# max APPEND in flight on a single session
+window = 32
 
 base_test_mb = "kzUXL7HyS5OjLcU8"
 parameters = {
   "dovecot": {
-    "con": IMAP4_SSL,
+    "con": IMAP4_SSL_Resume,
     "port": 993,
     "user": "test",
     "pw": "pass",
@@ -36,7 +146,7 @@ parameters = {
     "mb": base_test_mb,
   },
   "maddy": {
-    "con": IMAP4_SSL,
+    "con": IMAP4_SSL_Resume,
     "port": 994,
     "user": "test@example.com",
     "pw": "pass",
@@ -44,7 +154,7 @@ parameters = {
     "mb": base_test_mb,
   },
   "cyrus": {
-    "con": IMAP4,
+    "con": IMAP4_LiteralPlus,
     "port": 143,
     "user": "test",
     "pw": "pass",
@@ -52,7 +162,7 @@ parameters = {
     "mb": "INBOX."+base_test_mb,
   },
   "courier": {
-    "con": IMAP4,
+    "con": IMAP4_LiteralPlus,
     "port": 144,
     "user": "debian",
     "pw": "debian",
@@ -60,7 +170,7 @@ parameters = {
     "mb": base_test_mb,
   },
   "stalwart": {
-    "con": IMAP4_SSL,
+    "con": IMAP4_SSL_Resume,
     "port": 1993,
     "user": "test@example.com",
     "pw": "pass",
@@ -73,44 +183,199 @@ queue = list(parameters.keys())
 if mode in parameters:
     queue = [ mode ]
 
-onlyfiles = [join(path, f) for f in listdir(path) if isfile(join(path, f)) and len(f) > 4 and f[-4:] == ".eml"]
+onlyfiles = []
+for e in scandir(path):
+    if e.is_file() and e.name.endswith(".eml"):
+        if e.stat().st_size == 0:
+            print(f"skipping empty {e.path}")
+        else:
+            onlyfiles.append(e.path)
+
+# Sessions per (host, port, user, slot), kept open for the whole run and
+# reopened only when the server drops them. Each slot is used by one
+# thread at a time as imaplib objects are not thread safe.
+conns = {}
+
+def get_conn(conf, slot=0):
+    key = ("localhost", conf['port'], conf['user'], slot)
+    if key not in conns:
+        M = conf['con'](host="localhost", port=conf['port'])
+        print(M.login(conf['user'], conf['pw']))
+        # imaplib only keeps the capabilities announced before login
+        (r, caps) = M.capability()
+        M.capabilities = tuple(caps[-1].decode().upper().split())
+        # with TLS 1.3 the session ticket is only received after the
+        # handshake, it is there once logged in: store it right away
+        # so the other sessions to this server can resume it
+        if isinstance(M.sock, ssl.SSLSocket) and M.sock.session is not None:
+            tls_sessions[("localhost", conf['port'])] = M.sock.session
+        conns[key] = M
+    return conns[key]
+
+def reconnect(conf, slot=0):
+    M = conns.pop(("localhost", conf['port'], conf['user'], slot), None)
+    if M is not None:
+        try:
+            M.shutdown()
+        except OSError:
+            pass
+    return get_conn(conf, slot)
+
+# A failed reconnect leaves a slot without session and a refused SELECT
+# leaves it unselected: only close what is still open and selected.
+def close_conns(conf):
+    for (key, M) in conns.items():
+        if key[1:3] == (conf['port'], conf['user']) and M.state == 'SELECTED':
+            try:
+                M.close()
+            except (IMAP4.error, OSError):
+                pass
+
+def has_uidplus(M):
+    return 'UIDPLUS' in M.capabilities
+
+# what a single mail can fail with: server errors and refusals, a lost
+# connection or a response we can't parse. Anything else is a bug.
+DUMP_ERRORS = (IMAP4.error, AssertionError, OSError, KeyError, ValueError)
+
+APPENDUID = re.compile(rb'\[APPENDUID \d+ (\d+)\]')
+
+# Responses can hold whole messages, only log their size
+def log(r, b):
+    if args.verbose:
+        size = sum([sum(map(len, e)) if isinstance(e, tuple) else len(e or b'') for e in b])
+        sys.stdout.write(f"{r} {size} bytes\n")
+
+def dump(M, conf, content, seq, f_noext):
+    log(*M.append(conf['mb'], [], None, content))
+    (r, b) = M.fetch(seq, "(BODY BODYSTRUCTURE)")
+    log(r, b)
+    assert r == 'OK'
+    write_dump(conf, f_noext, fetch_items(b))
+
+def write_dump(conf, f_noext, items):
+    with open(f_noext + conf['ext'] + ".body", 'w+b') as w:
+        w.write(b'(BODY ' + items[b'BODY'] + b')')
+
+    with open(f_noext + conf['ext'] + ".bodystructure", 'w+b') as w:
+        w.write(b'(BODYSTRUCTURE ' + items[b'BODYSTRUCTURE'] + b')')
+
+# With UIDPLUS, messages are fetched by the UID returned by APPEND, which
+# does not depend on the order in which they reach the mailbox: the
+# APPEND of a whole chunk can be pipelined on one session, then all
+# its messages are fetched at once and matched back by UID.
+# uids maps the UID of each file already appended, the caller keeps it
+# across a reconnect so that these files are not appended again.
+def dump_chunk(M, conf, files, contents, uids):
+    failed = 0
+    appended = set(uids.values())
+    todo = [i for (i, f) in enumerate(files) if f not in appended]
+    results = M.append_many(conf['mb'], [contents[i] for i in todo])
+    for (i, (r, d)) in zip(todo, results):
+        f = files[i]
+        log(r, d)
+        uid = APPENDUID.search(d[-1]) if r == 'OK' else None
+        if uid is None:
+            failed += 1
+            print(f"failed {f}")
+        else:
+            uids[uid.group(1)] = f
+    if not uids:
+        return failed
+
+    (r, b) = M.uid('FETCH', b','.join(uids), "(BODY BODYSTRUCTURE)")
+    log(r, b)
+    assert r == 'OK'
+    missing = dict(uids)
+    for msg in split_fetch(b):
+        f = None
+        try:
+            items = fetch_items(msg)
+            f = missing.pop(items.get(b'UID'), None)
+            if f is not None:
+                write_dump(conf, f[:-4], items)
+        except DUMP_ERRORS:
+            # a response we can't parse leaves its file in missing,
+            # it is reported with the ones that were not returned
+            if f is not None:
+                failed += 1
+                print(f"failed {f}")
+    for f in missing.values():
+        failed += 1
+        print(f"failed {f}")
+    return failed
+
+def dump_uid(conf, slots, files):
+    slot = slots.get()
+    uids = {}
+    try:
+        contents = [map_mail(f) for f in files]
+        try:
+            M = get_conn(conf, slot)
+            if M.state != 'SELECTED':
+                print(M.select(conf['mb']))
+            return dump_chunk(M, conf, files, contents, uids)
+        except (IMAP4.abort, OSError):
+            # only the files without a UID yet are appended again, one whose
+            # APPEND response was lost with the connection may end up twice
+            print(f"connection lost, retrying {[f for f in files if f not in uids.values()]}")
+            M = reconnect(conf, slot)
+            print(M.select(conf['mb']))
+            return dump_chunk(M, conf, files, contents, uids)
+    except DUMP_ERRORS:
+        print(f"failed {files}")
+        return len(files)
+    finally:
+        slots.put(slot)
 
 for target in queue:
     print(f"--- {target} ---")
     conf = parameters[target]
     test_mb = conf['mb']
 
-    with conf['con'](host="localhost", port=conf['port']) as M:
-        print(M.login(conf['user'], conf['pw']))
-        print(M.delete(test_mb))
-        print(M.create(test_mb))
+    M = get_conn(conf)
+    print(M.delete(test_mb))
+    print(M.create(test_mb))
 
 
-        print(M.list())
-        print(M.select(test_mb))
-        failed = 0
+    print(M.list())
+    print(M.select(test_mb))
+    failed = 0
+    if has_uidplus(M):
+        slots = Queue()
+        for slot in range(workers):
+            print(get_conn(conf, slot).select(test_mb))
+            slots.put(slot)
+        size = max(1, min(window, -(-len(onlyfiles) // workers)))
+        chunks = [onlyfiles[i:i+size] for i in range(0, len(onlyfiles), size)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            failed = sum(pool.map(lambda files: dump_uid(conf, slots, files), chunks))
+    else:
         for (idx, f) in enumerate(onlyfiles):
             f_noext = f[:-4]
             try:
-                with open(f, 'r+b') as mail:
-                    print(M.append(test_mb, [], None, mail.read()))
+                content = map_mail(f)
+                try:
                     seq = (f"{idx+1-failed}:{idx+1-failed}").encode()
-                    (r, b) = M.fetch(seq, "(BODY)")
-                    print((r, b))
-                    assert r == 'OK'
-            
-
-                    with open(f_noext + conf['ext'] + ".body", 'w+b') as w:
-                        w.write(rebuild_body_res(b))
-
-                    (r, b) = M.fetch(seq, "(BODYSTRUCTURE)")
-                    print((r, b))
-                    assert r == 'OK'
-                    with open(f_noext + conf['ext'] + ".bodystructure", 'w+b') as w:
-                        w.write(rebuild_body_res(b))
-            except:
+                    dump(M, conf, content, seq, f_noext)
+                except (IMAP4.abort, OSError):
+                    print(f"connection lost, retrying {f}")
+                    M = reconnect(conf)
+                    (r, d) = M.select(test_mb)
+                    print((r, d))
+                    # the lost APPEND may have gone through, resync on the mailbox size
+                    failed = idx - int(d[0])
+                    seq = (f"{idx+1-failed}:{idx+1-failed}").encode()
+                    dump(M, conf, content, seq, f_noext)
+            except DUMP_ERRORS:
                 failed += 1
                 print(f"failed {f}")
 
-        M.close()
+    close_conns(conf)
+    print(f"{len(onlyfiles) - failed}/{len(onlyfiles)} dumped")
+
+for M in conns.values():
+    try:
         M.logout()
+    except (IMAP4.error, OSError):
+        pass
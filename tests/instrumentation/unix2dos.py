@@ -1,15 +1,30 @@
 #!/usr/bin/env python3
+import mmap
+import os
+import shutil
 import sys
+import tempfile
 
-buf = ""
-with open(sys.argv[1], 'r+b') as f:
-    buf = f.read()
+BUFSIZE = 1 << 20
+CHUNK = 16 << 20
 
-if buf.find(b'\r\n'):
-    print(f"{sys.argv[1]} is already a CRLF file")
+path = sys.argv[1]
+with open(path, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+        sys.exit(0)
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+if mm.find(b'\r\n') != -1:
+    print(f"{path} is already a CRLF file")
     sys.exit(1)
 
-buf = buf.replace(b'\n', b'\r\n')
+# No CRLF in the file, so a chunk boundary can't split one:
+# each chunk can be converted on its own.
+tmpdir = os.path.dirname(os.path.abspath(path))
+with tempfile.NamedTemporaryFile(dir=tmpdir, delete=False, buffering=BUFSIZE) as out:
+    for off in range(0, len(mm), CHUNK):
+        out.write(mm[off:off+CHUNK].replace(b'\n', b'\r\n'))
+mm.close()
 
-with open(sys.argv[1], 'w+b') as f:
-    f.write(buf)
+shutil.copymode(path, out.name)
+os.replace(out.name, path)